@@ -1,7 +1,14 @@
 import os
 import re
+import asyncio
 import sqlite3
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from time import monotonic
 from datetime import datetime, timedelta, timezone, time
 from dotenv import load_dotenv
 
@@ -18,247 +25,454 @@ DB_PATH = "chromos.db"
 
 RESET_UTC_TIME = time(hour=0, minute=0, tzinfo=timezone.utc)
 RECENT_DAYS_WINDOW = 7
+CHECK_CACHE_TTL = 30
+SEEN_MIN_INTERVAL = 60
+SEEN_CACHE_SIZE = 1024
+SCHEMA_VERSION = 4
+STATS_RETENTION_DAYS = 30
 DAILY_START_BALANCE = 75
 ALERT_THRESHOLD = 21
 
-IMMUNE_USERS = set()
+IMMUNE_USERS = frozenset()
+_IMMUNE_USERS_PARAMS = {f"imm{i}": uname for i, uname in enumerate(sorted(IMMUNE_USERS))}
+_IMMUNE_USERS_SQL = ", ".join(f":{k}" for k in _IMMUNE_USERS_PARAMS)
+_IMMUNE_CACHE: dict[int, tuple[frozenset[int], frozenset[str]]] = {}
+_CHAT_LOCKS: dict[int, asyncio.Lock] = {}
+_CHAT_LOCK_USERS: dict[int, int] = {}
+_CHECK_CACHE: dict[int, tuple[float, int, tuple[list, list]]] = {}
+_SEEN_BUF: dict[tuple[int, int], tuple[str | None, int]] = {}
+_SEEN_RENAMED: set[int] = set()
+_SEEN_LOCK = threading.Lock()
+_LAST_SEEN_TS: OrderedDict[tuple[int, int], tuple[float, str | None]] = OrderedDict()
 OWNER_ID = int(os.getenv("OWNER_ID", "5285094498"))
 
-MENTION_RE = re.compile(r"@([A-Za-z0-9_]{5,})")
-
+MENTION_RE = re.compile(r"@([A-Za-z0-9_]{5,})", re.ASCII)
+CMD_TOKENS_RE = re.compile(r"@([A-Za-z0-9_]{5,})|(\d+)", re.ASCII)
+CHAT_ID_RE = re.compile(r"-?\d+", re.ASCII)
+
+_START_TEXT = (
+    "Bot activo.\n"
+    "Comandos:\n"
+    "• /down — Elige el mogólico del día (excluye inmunes)\n"
+    "• /regalar — /regalar @usuario 10 | responder con /regalar 10 | /regalar <user_id> 10\n"
+    "• /check — Lista del día\n"
+    "• /randomdown — (reply / @ / id)\n"
+    "• /esdaun <texto|@usuario>\n"
+    "• /chatid — muestra el ID del chat\n"
+    "Privado (owner): /immune_add /immune_remove /immune_list"
+)
+_COMANDOS_TEXT = (
+    "/down — Elige el mogólico del día (excluye inmunes)\n"
+    "/regalar — /regalar @usuario 10 | responder con /regalar 10 | /regalar <user_id> 10\n"
+    "/check — Lista del día\n"
+    "/randomdown — (reply / @ / id)\n"
+    "/esdaun <texto|@usuario>\n"
+    "/chatid — muestra el ID del chat\n"
+    "Privado: /immune_add /immune_remove /immune_list"
+)
+_RDOWN_ON = "está re mogólico hoy 🔥"
+_RDOWN_OFF = "no le agarró el daun todavía 😌"
+_ESDAUN_TEMPLATES = ("Hoy {} está re daun", "Por ahora a {} no se le activó el daun")
+
+SQL_PURGE_SELECTION = "DELETE FROM daily_selection WHERE day < ?"
+SQL_HAS_STATS_OLD = "SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_stats_old'"
+SQL_PURGE_STATS_OLD = "DELETE FROM daily_stats_old WHERE day < ?"
+SQL_ANY_STATS_OLD = "SELECT 1 FROM daily_stats_old LIMIT 1"
+SQL_ISO_TO_DAY_KEY = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+SQL_UPSERT_USER = """
+    INSERT INTO users (chat_id, user_id, username, last_seen, balance)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id)
+    DO UPDATE SET username=excluded.username, last_seen=excluded.last_seen
+"""
+SQL_ADD_IMMUNE_ID = "INSERT OR IGNORE INTO immune_id (chat_id, user_id) VALUES (?, ?)"
+SQL_ADD_IMMUNE_USERNAME = "INSERT OR IGNORE INTO immune_username (chat_id, username) VALUES (?, ?)"
+SQL_DEL_IMMUNE_ID = "DELETE FROM immune_id WHERE chat_id=? AND user_id=?"
+SQL_DEL_IMMUNE_USERNAME = "DELETE FROM immune_username WHERE chat_id=? AND username=?"
+SQL_LIST_IMMUNE_ID = "SELECT user_id FROM immune_id WHERE chat_id=?"
+SQL_LIST_IMMUNE_USERNAME = "SELECT username FROM immune_username WHERE chat_id=?"
+SQL_ALL_IMMUNE_ID = "SELECT chat_id, user_id FROM immune_id"
+SQL_ALL_IMMUNE_USERNAME = "SELECT chat_id, username FROM immune_username"
+SQL_RANDOM_RECENT_USER = f"""
+    SELECT u.user_id, COALESCE(u.username, '')
+      FROM users u
+      LEFT JOIN immune_id i1 ON i1.chat_id=u.chat_id AND i1.user_id=u.user_id
+      LEFT JOIN immune_username i2 ON i2.chat_id=u.chat_id AND i2.username=u.username
+     WHERE u.chat_id=:chat AND u.last_seen >= :cutoff AND i1.user_id IS NULL AND i2.username IS NULL
+       AND (:exclude IS NULL OR u.user_id <> :exclude)
+       AND LOWER(COALESCE(u.username, '')) NOT IN ({_IMMUNE_USERS_SQL})
+     ORDER BY random() LIMIT 1
+"""
+SQL_SELECT_BALANCE = """
+    SELECT CASE WHEN COALESCE(balance_day, 0) < :day THEN :start ELSE balance END
+      FROM users WHERE chat_id=:chat AND user_id=:user
+"""
+SQL_ADJUST_BAL = """
+    UPDATE users
+       SET balance = (CASE WHEN COALESCE(balance_day, 0) < :day THEN :start ELSE balance END) + :delta,
+           balance_day = :day
+     WHERE chat_id=:chat AND user_id=:user
+       AND (CASE WHEN COALESCE(balance_day, 0) < :day THEN :start ELSE balance END) + :delta >= 0
+    RETURNING balance
+"""
+SQL_ADD_STATS = """
+    UPDATE users
+       SET given_today = (CASE WHEN stats_day = :day THEN given_today ELSE 0 END) + :given,
+           received_today = (CASE WHEN stats_day = :day THEN received_today ELSE 0 END) + :received,
+           stats_day = :day
+     WHERE chat_id=:chat AND user_id=:user
+    RETURNING received_today
+"""
+SQL_REBOUND_RECEIVED = """
+    UPDATE users
+       SET received_today = CASE WHEN user_id=:dest
+                                 THEN MAX((CASE WHEN stats_day = :day THEN received_today ELSE 0 END) - :amt, 0)
+                                 ELSE (CASE WHEN stats_day = :day THEN received_today ELSE 0 END) + :amt END,
+           given_today = CASE WHEN stats_day = :day THEN given_today ELSE 0 END,
+           stats_day = :day
+     WHERE chat_id=:chat AND user_id IN (:dest, :alt)
+    RETURNING user_id, received_today
+"""
+SQL_MARK_SELECTION = "INSERT OR IGNORE INTO daily_selection (chat_id, day, user_id) VALUES (?, ?, ?)"
+SQL_HIGHLIGHTS = """
+    SELECT 'recv', user_id, COALESCE(username,''), received_today
+      FROM users
+     WHERE chat_id=:chat AND stats_day=:day AND received_today > :threshold
+    UNION ALL
+    SELECT 'sel', u.user_id, COALESCE(u.username,''), 0
+      FROM daily_selection d
+      JOIN users u ON u.chat_id=d.chat_id AND u.user_id=d.user_id
+     WHERE d.chat_id=:chat AND d.day=:day
+     ORDER BY 1, 4 DESC
+"""
+SQL_USER_BY_USERNAME = """
+    SELECT user_id, COALESCE(username,'') FROM users
+     WHERE chat_id=? AND username=? COLLATE NOCASE
+"""
+SQL_USER_BY_ID = """
+    SELECT user_id, COALESCE(username,'') FROM users
+     WHERE chat_id=? AND user_id=?
+"""
+
+_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+_DB_EXEC = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_DB_LOCK = threading.RLock()
+
+@contextmanager
 def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+    with _DB_LOCK:
+        yield _CONN
+
+@contextmanager
+def tx():
+    with _DB_LOCK:
+        if _CONN.in_transaction:
+            yield _CONN
+            return
+        _CONN.execute("BEGIN IMMEDIATE")
+        try:
+            yield _CONN
+        except BaseException:
+            _CONN.execute("ROLLBACK")
+            raise
+        _CONN.execute("COMMIT")
 
 def init_db():
     with db() as conn:
-        conn.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-          chat_id   INTEGER NOT NULL,
-          user_id   INTEGER NOT NULL,
-          username  TEXT,
-          last_seen TIMESTAMP NULL,
-          balance   INTEGER NOT NULL DEFAULT 0,
-          PRIMARY KEY (chat_id, user_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS daily_stats (
-          chat_id   INTEGER NOT NULL,
-          user_id   INTEGER NOT NULL,
-          day       DATE    NOT NULL,
-          given     INTEGER NOT NULL DEFAULT 0,
-          received  INTEGER NOT NULL DEFAULT 0,
-          PRIMARY KEY (chat_id, user_id, day),
-          FOREIGN KEY (chat_id, user_id) REFERENCES users(chat_id, user_id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS daily_selection (
-          chat_id INTEGER NOT NULL,
-          day     DATE    NOT NULL,
-          user_id INTEGER NOT NULL,
-          PRIMARY KEY (chat_id, day, user_id),
-          FOREIGN KEY (chat_id, user_id) REFERENCES users(chat_id, user_id) ON DELETE CASCADE
-        );
-
-        CREATE TABLE IF NOT EXISTS immune_id (
-          chat_id INTEGER NOT NULL,
-          user_id INTEGER NOT NULL,
-          PRIMARY KEY (chat_id, user_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS immune_username (
-          chat_id  INTEGER NOT NULL,
-          username TEXT COLLATE NOCASE NOT NULL,
-          PRIMARY KEY (chat_id, username)
-        );
-        """)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA wal_autocheckpoint=1000")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=134217728")
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            _migrate_schema(conn)
+        conn.execute("PRAGMA analysis_limit=400")
+        conn.execute("ANALYZE")
+    preload_immune_sets()
     print("DB OK")
 
+def _migrate_schema(conn: sqlite3.Connection):
+    conn.executescript("""
+    BEGIN IMMEDIATE;
+
+    CREATE TABLE IF NOT EXISTS users (
+      chat_id   INTEGER NOT NULL,
+      user_id   INTEGER NOT NULL,
+      username  TEXT,
+      last_seen INTEGER NULL,
+      balance   INTEGER NOT NULL DEFAULT 0,
+      balance_day INTEGER NULL,
+      given_today    INTEGER NOT NULL DEFAULT 0,
+      received_today INTEGER NOT NULL DEFAULT 0,
+      stats_day      INTEGER NULL,
+      PRIMARY KEY (chat_id, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS daily_selection (
+      chat_id INTEGER NOT NULL,
+      day     INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      PRIMARY KEY (chat_id, day, user_id),
+      FOREIGN KEY (chat_id, user_id) REFERENCES users(chat_id, user_id) ON DELETE CASCADE
+    );
+
+    CREATE TABLE IF NOT EXISTS immune_id (
+      chat_id INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      PRIMARY KEY (chat_id, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS immune_username (
+      chat_id  INTEGER NOT NULL,
+      username TEXT COLLATE NOCASE NOT NULL,
+      PRIMARY KEY (chat_id, username)
+    );
+    """)
+    try:
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+        if "balance_day" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN balance_day INTEGER NULL")
+            conn.execute("UPDATE users SET balance_day=?", (today_key(),))
+        if "stats_day" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN given_today INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE users ADD COLUMN received_today INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE users ADD COLUMN stats_day INTEGER NULL")
+        for name in ("idx_users_chat_seen", "idx_users_chat_uname", "idx_users_chat_stats_recv"):
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_seen_cov ON users(chat_id, last_seen, user_id, username)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_uname_cov ON users(chat_id, username COLLATE NOCASE, user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_stats_cov ON users(chat_id, stats_day, received_today DESC, user_id, username)")
+        conn.execute(f"UPDATE daily_selection SET day = {SQL_ISO_TO_DAY_KEY.format('day')} WHERE typeof(day)='text'")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_stats'").fetchone():
+            # Los contadores del día pasan a users; el histórico queda en daily_stats_old
+            # y purge_old_days lo vacía con la misma retención hasta borrar la tabla.
+            conn.execute(f"UPDATE daily_stats SET day = {SQL_ISO_TO_DAY_KEY.format('day')} WHERE typeof(day)='text'")
+            conn.execute("""
+                UPDATE users SET given_today=s.given, received_today=s.received, stats_day=s.day
+                  FROM daily_stats s
+                 WHERE s.chat_id=users.chat_id AND s.user_id=users.user_id AND s.day=?
+            """, (today_key(),))
+            conn.execute("ALTER TABLE daily_stats RENAME TO daily_stats_old")
+        conn.execute(f"UPDATE users SET balance_day = {SQL_ISO_TO_DAY_KEY.format('balance_day')} WHERE typeof(balance_day)='text'")
+        conn.execute("UPDATE users SET last_seen = CAST(strftime('%s', last_seen) AS INTEGER) WHERE typeof(last_seen)='text'")
+        conn.execute("ANALYZE")
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
 def now_utc():
     return datetime.now(timezone.utc)
 
+def epoch_seconds(ts: datetime) -> int:
+    return int(ts.timestamp())
+
+def day_key(ts: datetime) -> int:
+    return epoch_seconds(ts) // 86400
+
 def today_key():
-    return now_utc().date()
+    return day_key(now_utc())
 
-def upsert_user(chat_id: int, user_id: int, username: str | None):
+def upsert_user(chat_id: int, user_id: int, username: str | None, now: datetime | None = None):
     with db() as conn:
-        conn.execute("""
-            INSERT INTO users (chat_id, user_id, username, last_seen, balance)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id, user_id)
-            DO UPDATE SET username=excluded.username, last_seen=excluded.last_seen
-        """, (chat_id, user_id, username, now_utc(), DAILY_START_BALANCE))
+        conn.execute(SQL_UPSERT_USER, (chat_id, user_id, username, epoch_seconds(now or now_utc()), DAILY_START_BALANCE))
 
-def seen_user(chat_id: int, user_id: int, username: str | None):
-    upsert_user(chat_id, user_id, username)
+def seen_user(chat_id: int, user_id: int, username: str | None, now: datetime | None = None):
+    key = (chat_id, user_id)
+    t = monotonic()
+    prev = _LAST_SEEN_TS.get(key)
+    if prev and t - prev[0] < SEEN_MIN_INTERVAL and prev[1] == username:
+        return
+    renamed = prev is not None and prev[1] != username
+    _LAST_SEEN_TS[key] = (t, username)
+    _LAST_SEEN_TS.move_to_end(key)
+    if len(_LAST_SEEN_TS) > SEEN_CACHE_SIZE:
+        _LAST_SEEN_TS.popitem(last=False)
+    with _SEEN_LOCK:
+        _SEEN_BUF[key] = (username, epoch_seconds(now or now_utc()))
+        if renamed:
+            _SEEN_RENAMED.add(chat_id)
+
+def flush_seen_users():
+    global _SEEN_BUF, _SEEN_RENAMED
+    with _SEEN_LOCK:
+        if not _SEEN_BUF:
+            return
+        buf, _SEEN_BUF = _SEEN_BUF, {}
+        renamed, _SEEN_RENAMED = _SEEN_RENAMED, set()
+    rows = [(chat_id, user_id, uname, ts, DAILY_START_BALANCE) for (chat_id, user_id), (uname, ts) in buf.items()]
+    with tx() as conn:
+        conn.executemany(SQL_UPSERT_USER, rows)
+    for chat_id in renamed:
+        _CHECK_CACHE.pop(chat_id, None)
 
 def is_user_immune(chat_id: int, user_id: int | None, username: str | None) -> bool:
     uname_lc = (username or "").lower()
     if uname_lc in IMMUNE_USERS:
         return True
+    ids, unames = _immune_sets(chat_id)
+    return bool(user_id and user_id in ids) or bool(uname_lc and uname_lc in unames)
+
+def _immune_sets(chat_id: int) -> tuple[frozenset[int], frozenset[str]]:
+    cached = _IMMUNE_CACHE.get(chat_id)
+    if cached is None:
+        with db() as conn:
+            ids = frozenset(r[0] for r in conn.execute(SQL_LIST_IMMUNE_ID, (chat_id,)))
+            unames = frozenset(r[0].lower() for r in conn.execute(SQL_LIST_IMMUNE_USERNAME, (chat_id,)))
+        cached = _IMMUNE_CACHE[chat_id] = (ids, unames)
+    return cached
+
+def preload_immune_sets():
+    ids: dict[int, set[int]] = {}
+    unames: dict[int, set[str]] = {}
     with db() as conn:
-        if user_id and conn.execute(
-            "SELECT 1 FROM immune_id WHERE chat_id=? AND user_id=?",
-            (chat_id, user_id)
-        ).fetchone():
-            return True
-        if uname_lc and conn.execute(
-            "SELECT 1 FROM immune_username WHERE chat_id=? AND username=?",
-            (chat_id, uname_lc)
-        ).fetchone():
-            return True
-    return False
+        for chat_id, user_id in conn.execute(SQL_ALL_IMMUNE_ID):
+            ids.setdefault(chat_id, set()).add(user_id)
+        for chat_id, uname in conn.execute(SQL_ALL_IMMUNE_USERNAME):
+            unames.setdefault(chat_id, set()).add(uname.lower())
+    for chat_id in ids.keys() | unames.keys():
+        _IMMUNE_CACHE[chat_id] = (frozenset(ids.get(chat_id, ())), frozenset(unames.get(chat_id, ())))
 
 def add_immune(chat_id: int, user_id: int | None, username: str | None) -> bool:
-    with db() as conn:
-        try:
+    try:
+        with tx() as conn:
             if user_id:
-                conn.execute("INSERT OR IGNORE INTO immune_id (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
+                conn.execute(SQL_ADD_IMMUNE_ID, (chat_id, user_id))
             if username:
-                conn.execute("INSERT OR IGNORE INTO immune_username (chat_id, username) VALUES (?, ?)", (chat_id, username.lower()))
-            return True
-        except Exception:
-            return False
+                conn.execute(SQL_ADD_IMMUNE_USERNAME, (chat_id, username.lower()))
+        _IMMUNE_CACHE.pop(chat_id, None)
+        return True
+    except Exception:
+        return False
 
 def remove_immune(chat_id: int, user_id: int | None, username: str | None) -> int:
     uname_lc = (username or "").lower()
-    with db() as conn:
+    with tx() as conn:
         total = 0
         if user_id:
-            total += conn.execute("DELETE FROM immune_id WHERE chat_id=? AND user_id=?", (chat_id, user_id)).rowcount
+            total += conn.execute(SQL_DEL_IMMUNE_ID, (chat_id, user_id)).rowcount
         if uname_lc:
-            total += conn.execute("DELETE FROM immune_username WHERE chat_id=? AND username=?", (chat_id, uname_lc)).rowcount
-        return total
+            total += conn.execute(SQL_DEL_IMMUNE_USERNAME, (chat_id, uname_lc)).rowcount
+    _IMMUNE_CACHE.pop(chat_id, None)
+    return total
 
 def list_immunes(chat_id: int):
     with db() as conn:
-        rows_id = conn.execute("SELECT user_id FROM immune_id WHERE chat_id=?", (chat_id,)).fetchall()
-        rows_un = conn.execute("SELECT username FROM immune_username WHERE chat_id=?", (chat_id,)).fetchall()
+        rows_id = conn.execute(SQL_LIST_IMMUNE_ID, (chat_id,)).fetchall()
+        rows_un = conn.execute(SQL_LIST_IMMUNE_USERNAME, (chat_id,)).fetchall()
     return [(r[0], "") for r in rows_id] + [(0, r[0]) for r in rows_un]
 
-def get_recent_users(chat_id: int):
-    cutoff = now_utc() - timedelta(days=RECENT_DAYS_WINDOW)
-    with db() as conn:
-        rows = conn.execute("""
-            SELECT user_id, COALESCE(username, '')
-            FROM users
-            WHERE chat_id=? AND last_seen >= ?
-        """, (chat_id, cutoff.isoformat())).fetchall()
-    return [(uid, uname) for uid, uname in rows if not is_user_immune(chat_id, uid, uname)]
-
-def ensure_stats_row(chat_id: int, user_id: int, day):
+def pick_random_recent(chat_id: int, now: datetime | None = None, exclude_uid: int | None = None):
+    cutoff = epoch_seconds((now or now_utc()) - timedelta(days=RECENT_DAYS_WINDOW))
     with db() as conn:
-        conn.execute("""
-            INSERT OR IGNORE INTO daily_stats (chat_id, user_id, day)
-            VALUES (?, ?, ?)
-        """, (chat_id, user_id, str(day)))
+        return conn.execute(SQL_RANDOM_RECENT_USER, {"chat": chat_id, "cutoff": cutoff,
+                                                     "exclude": exclude_uid, **_IMMUNE_USERS_PARAMS}).fetchone()
 
-def adjust_balance(chat_id: int, user_id: int, delta: int):
+def get_balance(chat_id: int, user_id: int, day) -> int:
     with db() as conn:
-        row = conn.execute("SELECT balance FROM users WHERE chat_id=? AND user_id=?", (chat_id, user_id)).fetchone()
-        if not row:
-            return False, 0
-        bal = row[0]
-        new_bal = bal + delta
-        if new_bal < 0:
-            return False, bal
-        conn.execute("UPDATE users SET balance=? WHERE chat_id=? AND user_id=?", (new_bal, chat_id, user_id))
-        return True, new_bal
-
-def add_given_received(chat_id: int, giver_id: int, recipient_id: int, amount: int, day):
+        row = conn.execute(SQL_SELECT_BALANCE, {"day": day, "start": DAILY_START_BALANCE,
+                                                "chat": chat_id, "user": user_id}).fetchone()
+    return row[0] if row else 0
+
+def adjust_balance(chat_id: int, user_id: int, delta: int, day):
     with db() as conn:
-        conn.execute("""INSERT OR IGNORE INTO daily_stats (chat_id, user_id, day, given, received) VALUES (?, ?, ?, 0, 0)""",
-                     (chat_id, giver_id, str(day)))
-        conn.execute("""INSERT OR IGNORE INTO daily_stats (chat_id, user_id, day, given, received) VALUES (?, ?, ?, 0, 0)""",
-                     (chat_id, recipient_id, str(day)))
-        conn.execute("""UPDATE daily_stats SET given = given + ? WHERE chat_id=? AND user_id=? AND day=?""",
-                     (amount, chat_id, giver_id, str(day)))
-        conn.execute("""UPDATE daily_stats SET received = received + ? WHERE chat_id=? AND user_id=? AND day=?""",
-                     (amount, chat_id, recipient_id, str(day)))
-
-def get_received_today(chat_id: int, user_id: int, day):
+        rows = conn.execute(SQL_ADJUST_BAL, {"day": day, "start": DAILY_START_BALANCE, "delta": delta,
+                                             "chat": chat_id, "user": user_id}).fetchall()
+    if rows:
+        return True, rows[0][0]
+    return False, get_balance(chat_id, user_id, day)
+
+def add_given_received(chat_id: int, giver_id: int, recipient_id: int, amount: int, day) -> int:
+    with tx() as conn:
+        conn.execute(SQL_ADD_STATS, {"day": day, "given": amount, "received": 0,
+                                     "chat": chat_id, "user": giver_id}).fetchall()
+        rows = conn.execute(SQL_ADD_STATS, {"day": day, "given": 0, "received": amount,
+                                            "chat": chat_id, "user": recipient_id}).fetchall()
+    _CHECK_CACHE.pop(chat_id, None)
+    return rows[0][0] if rows else 0
+
+def transfer_balance(chat_id: int, giver_id: int, recipient_id: int, amount: int, day):
+    with tx():
+        ok, bal = adjust_balance(chat_id, giver_id, -amount, day)
+        if not ok:
+            return False, bal, 0
+        return True, bal, add_given_received(chat_id, giver_id, recipient_id, amount, day)
+
+def rebound_received(chat_id: int, dest_id: int, alt_id: int, amount: int, day) -> int:
     with db() as conn:
-        row = conn.execute("""SELECT received FROM daily_stats WHERE chat_id=? AND user_id=? AND day=?""",
-                           (chat_id, user_id, str(day))).fetchone()
-    return row[0] if row else 0
+        rows = conn.execute(SQL_REBOUND_RECEIVED, {"amt": amount, "chat": chat_id, "day": day,
+                                                   "dest": dest_id, "alt": alt_id}).fetchall()
+    _CHECK_CACHE.pop(chat_id, None)
+    return next((received for uid, received in rows if uid == alt_id), 0)
 
 def mark_selection_today(chat_id: int, user_id: int, day):
     with db() as conn:
-        conn.execute("""INSERT OR IGNORE INTO daily_selection (chat_id, day, user_id) VALUES (?, ?, ?)""",
-                     (chat_id, str(day), user_id))
+        conn.execute(SQL_MARK_SELECTION, (chat_id, day, user_id))
+    _CHECK_CACHE.pop(chat_id, None)
 
 def list_today_highlights(chat_id: int, day):
+    cached = _CHECK_CACHE.get(chat_id)
+    if cached and cached[1] == day and monotonic() - cached[0] < CHECK_CACHE_TTL:
+        return cached[2]
     with db() as conn:
-        rec = conn.execute("""
-            SELECT u.user_id, COALESCE(u.username,''), s.received
-              FROM daily_stats s
-              JOIN users u ON u.chat_id=s.chat_id AND u.user_id=s.user_id
-             WHERE s.chat_id=? AND s.day=? AND s.received > ?
-             ORDER BY s.received DESC
-        """, (chat_id, str(day), ALERT_THRESHOLD)).fetchall()
-        sel = conn.execute("""
-            SELECT u.user_id, COALESCE(u.username,'')
-              FROM daily_selection d
-              JOIN users u ON u.chat_id=d.chat_id AND u.user_id=d.user_id
-             WHERE d.chat_id=? AND d.day=?
-        """, (chat_id, str(day))).fetchall()
+        rows = conn.execute(SQL_HIGHLIGHTS, {"chat": chat_id, "day": day, "threshold": ALERT_THRESHOLD}).fetchall()
+    rec = [(uid, uname, received) for kind, uid, uname, received in rows if kind == "recv"]
+    sel = [(uid, uname) for kind, uid, uname, _ in rows if kind == "sel"]
+    _CHECK_CACHE[chat_id] = (monotonic(), day, (rec, sel))
     return rec, sel
 
+@lru_cache(maxsize=4096)
 def format_mention(uid: int, uname: str):
     return f"@{uname}" if uname else f'<a href="tg://user?id={uid}">usuario</a>'
 
-def resolve_target_from_update(update: Update, text: str):
+def parse_cmd_tokens(text: str):
+    mention = None
+    nums = []
+    for m in CMD_TOKENS_RE.finditer(text or ""):
+        if m.group(2):
+            nums.append(m.group(2))
+        elif mention is None:
+            mention = m.group(1)
+    return mention, nums
+
+def parse_chat_id_arg(text: str):
+    for tok in (text or "").split()[1:]:
+        if CHAT_ID_RE.fullmatch(tok):
+            return int(tok)
+    return None
+
+def resolve_target_from_update(update: Update, mention: str | None, nums: list[str], now: datetime | None = None):
     chat_id = update.effective_chat.id
     if update.message and update.message.reply_to_message:
         u = update.message.reply_to_message.from_user
-        seen_user(chat_id, u.id, u.username)
+        upsert_user(chat_id, u.id, u.username, now)
         return u.id, (u.username or "")
-    m = MENTION_RE.search(text or "")
-    if m:
-        uname = m.group(1)
+    if mention:
         with db() as conn:
-            row = conn.execute("""
-                SELECT user_id, COALESCE(username,'') FROM users
-                 WHERE chat_id=? AND LOWER(username)=LOWER(?)
-            """, (chat_id, uname)).fetchone()
+            row = conn.execute(SQL_USER_BY_USERNAME, (chat_id, mention)).fetchone()
         if row:
             return row[0], row[1]
-    nums = re.findall(r"\d{6,}", text or "")
-    if nums:
-        uid = int(nums[-1])
+    ids = [n for n in nums if len(n) >= 6]
+    if ids:
+        uid = int(ids[-1])
         with db() as conn:
-            row = conn.execute("""
-                SELECT user_id, COALESCE(username,'') FROM users
-                 WHERE chat_id=? AND user_id=?
-            """, (chat_id, uid)).fetchone()
+            row = conn.execute(SQL_USER_BY_ID, (chat_id, uid)).fetchone()
         if row:
             return row[0], row[1]
     return None
 
+async def _run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXEC, fn, *args)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Bot activo.\n"
-        "Comandos:\n"
-        "• /down — Elige el mogólico del día (excluye inmunes)\n"
-        "• /regalar — /regalar @usuario 10 | responder con /regalar 10 | /regalar <user_id> 10\n"
-        "• /check — Lista del día\n"
-        "• /randomdown — (reply / @ / id)\n"
-        "• /esdaun <texto|@usuario>\n"
-        "• /chatid — muestra el ID del chat\n"
-        "Privado (owner): /immune_add /immune_remove /immune_list"
-    )
+    await update.message.reply_text(_START_TEXT)
 
 async def comandos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "/down — Elige el mogólico del día (excluye inmunes)\n"
-        "/regalar — /regalar @usuario 10 | responder con /regalar 10 | /regalar <user_id> 10\n"
-        "/check — Lista del día\n"
-        "/randomdown — (reply / @ / id)\n"
-        "/esdaun <texto|@usuario>\n"
-        "/chatid — muestra el ID del chat\n"
-        "Privado: /immune_add /immune_remove /immune_list"
-    )
+    await update.message.reply_text(_COMANDOS_TEXT)
 
 async def chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
@@ -271,30 +485,62 @@ async def seen_member(update: Update, _: ContextTypes.DEFAULT_TYPE):
     seen_user(chat.id, user.id, user.username)
 
 async def any_group_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat and update.effective_user:
+    if update.effective_chat and update.effective_user and not update.effective_user.is_bot:
         seen_user(update.effective_chat.id, update.effective_user.id, update.effective_user.username)
 
 async def down(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     sender = update.effective_user
-    seen_user(chat.id, sender.id, sender.username)
-    candidates = get_recent_users(chat.id)
-    if not candidates:
+    now = now_utc()
+    seen_user(chat.id, sender.id, sender.username, now)
+    await _run_db(flush_seen_users)
+    picked = await _run_db(pick_random_recent, chat.id, now)
+    if not picked:
         await update.message.reply_text("No encuentro usuarios activos en la última semana.")
         return
-    uid, uname = random.choice(candidates)
+    uid, uname = picked
     mention = format_mention(uid, uname)
     await update.message.reply_text(f"El mogólico del día es {mention}", parse_mode=ParseMode.HTML)
-    mark_selection_today(chat.id, uid, today_key())
+    await _run_db(mark_selection_today, chat.id, uid, day_key(now))
+
+def _lock_for(chat_id: int) -> asyncio.Lock:
+    lock = _CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = _CHAT_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
+async def flush_seen(context: ContextTypes.DEFAULT_TYPE):
+    await _run_db(flush_seen_users)
+
+async def flush_seen_on_shutdown(_app):
+    await _run_db(flush_seen_users)
+    await asyncio.to_thread(_DB_EXEC.shutdown, True)
+    with db() as conn:
+        conn.close()
 
 async def regalar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    _CHAT_LOCK_USERS[chat_id] = _CHAT_LOCK_USERS.get(chat_id, 0) + 1
+    try:
+        async with _lock_for(chat_id):
+            await _regalar(update, context)
+    finally:
+        _CHAT_LOCK_USERS[chat_id] -= 1
+        if not _CHAT_LOCK_USERS[chat_id]:
+            del _CHAT_LOCK_USERS[chat_id]
+            del _CHAT_LOCKS[chat_id]
+
+async def _regalar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     sender = update.effective_user
     text = update.message.text or ""
-    seen_user(chat.id, sender.id, sender.username)
+    now = now_utc()
+    day = day_key(now)
+    seen_user(chat.id, sender.id, sender.username, now)
+    await _run_db(flush_seen_users)
 
-    target = resolve_target_from_update(update, text)
-    nums = re.findall(r"\d+", text)
+    mention, nums = parse_cmd_tokens(text)
+    target = await _run_db(resolve_target_from_update, update, mention, nums, now)
     amount = int(nums[-1]) if nums else None
     if not target or amount is None or amount <= 0:
         await update.message.reply_text("Uso: /regalar @usuario 10  • o •  responder con /regalar 10  • o •  /regalar <user_id> 10")
@@ -304,71 +550,44 @@ async def regalar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No podés regalarte a vos mismo.")
         return
 
-    ok, new_bal = adjust_balance(chat.id, sender.id, -amount)
+    ok, new_bal, total_rec = await _run_db(transfer_balance, chat.id, sender.id, dest_id, amount, day)
     if not ok:
-        with db() as conn:
-            rowb = conn.execute("SELECT balance FROM users WHERE chat_id=? AND user_id=?", (chat.id, sender.id)).fetchone()
-        bal = rowb[0] if rowb else 0
-        await update.message.reply_text(f"No te alcanza el saldo. Te quedan {bal} cromosomas.")
+        await update.message.reply_text(f"No te alcanza el saldo. Te quedan {new_bal} cromosomas.")
         return
 
-    day = today_key()
-    ensure_stats_row(chat.id, sender.id, day)
-    ensure_stats_row(chat.id, dest_id, day)
-    add_given_received(chat.id, sender.id, dest_id, amount, day)
-
     dest_m = format_mention(dest_id, dest_uname or "")
     await update.message.reply_text(f"Listo: regalaste {amount} cromosomas a {dest_m}. Te quedan {new_bal}.", parse_mode=ParseMode.HTML)
 
-    total_rec = get_received_today(chat.id, dest_id, day)
     if total_rec >= ALERT_THRESHOLD:
-        if is_user_immune(chat.id, dest_id, dest_uname or ""):
-            candidates = [(uid, uun) for (uid, uun) in get_recent_users(chat.id) if uid != dest_id]
-            if not candidates:
+        if await _run_db(is_user_immune, chat.id, dest_id, dest_uname or ""):
+            alt = await _run_db(pick_random_recent, chat.id, now, dest_id)
+            if not alt:
                 await update.message.reply_text("El destinatario es inmune, pero no encuentro otro usuario activo para rebotar los cromosomas.")
                 return
-            alt_id, alt_uname = random.choice(candidates)
-            ensure_stats_row(chat.id, alt_id, day)
-            with db() as conn:
-                conn.execute("""
-                    UPDATE daily_stats
-                       SET received = CASE WHEN received >= ? THEN received - ? ELSE 0 END
-                     WHERE chat_id=? AND user_id=? AND day=?
-                """, (amount, amount, chat.id, dest_id, str(day)))
-                conn.execute("""
-                    UPDATE daily_stats
-                       SET received = received + ?
-                     WHERE chat_id=? AND user_id=? AND day=?
-                """, (amount, chat.id, alt_id, str(day)))
-            alt_total = get_received_today(chat.id, alt_id, day)
+            alt_id, alt_uname = alt
+            alt_total = await _run_db(rebound_received, chat.id, dest_id, alt_id, amount, day)
             alt_m = format_mention(alt_id, alt_uname)
             await update.message.reply_text(f"Como {dest_m} es inmune, los cromosomas le rebotan y caen en {alt_m}.", parse_mode=ParseMode.HTML)
             if alt_total >= ALERT_THRESHOLD:
                 await update.message.reply_text(f"¡{alt_m} es mogólico! (≥ {ALERT_THRESHOLD})", parse_mode=ParseMode.HTML)
-                mark_selection_today(chat.id, alt_id, day)
+                await _run_db(mark_selection_today, chat.id, alt_id, day)
         else:
             await update.message.reply_text(f"¡{dest_m} es mogólico!  (≥ {ALERT_THRESHOLD})!", parse_mode=ParseMode.HTML)
-            mark_selection_today(chat.id, dest_id, day)
+            await _run_db(mark_selection_today, chat.id, dest_id, day)
 
 async def check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     day = today_key()
-    recibieron, seleccionados = list_today_highlights(chat.id, day)
+    recibieron, seleccionados = await _run_db(list_today_highlights, chat.id, day)
 
     lines = []
     if recibieron:
         lines.append("<b>Recibieron &gt; 21 hoy:</b>")
-        for uid, uname, rec in recibieron:
-            lines.append(f"• {format_mention(uid, uname)} — recibió {rec}")
+        lines.extend(f"• {format_mention(uid, uname)} — recibió {rec}" for uid, uname, rec in recibieron)
     if seleccionados:
         lines.append("")
         lines.append("<b>Mogólico del día:</b>")
-        seen_set = set()
-        for uid, uname in seleccionados:
-            if uid in seen_set:
-                continue
-            seen_set.add(uid)
-            lines.append(f"• {format_mention(uid, uname)}")
+        lines.extend(f"• {format_mention(uid, uname)}" for uid, uname in seleccionados)
 
     if not lines:
         await update.message.reply_text("Hoy no hay destacados aún.")
@@ -378,17 +597,19 @@ async def check_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def randomdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     text = update.message.text or ""
-    target = resolve_target_from_update(update, text)
+    now = now_utc()
+    await _run_db(flush_seen_users)
+    target = await _run_db(resolve_target_from_update, update, *parse_cmd_tokens(text), now)
     if not target:
         await update.message.reply_text("Uso: /randomdown @usuario  • o •  responder con /randomdown  • o •  /randomdown <user_id>")
         return
     target_id, target_uname = target
     mention = format_mention(target_id, target_uname or "")
-    if random.choice([0, 1]) == 0:
-        await update.message.reply_text(f"{mention} está re mogólico hoy 🔥", parse_mode=ParseMode.HTML)
-        mark_selection_today(chat.id, target_id, today_key())
+    if random.getrandbits(1):
+        await update.message.reply_text(f"{mention} {_RDOWN_ON}", parse_mode=ParseMode.HTML)
+        await _run_db(mark_selection_today, chat.id, target_id, day_key(now))
     else:
-        await update.message.reply_text(f"a {mention} no le agarró el daun todavía 😌", parse_mode=ParseMode.HTML)
+        await update.message.reply_text(f"a {mention} {_RDOWN_OFF}", parse_mode=ParseMode.HTML)
 
 async def esdaun(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text or ""
@@ -402,8 +623,7 @@ async def esdaun(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not target_text:
         await update.message.reply_text("Uso: /esdaun <texto o @usuario> (o respondé a un mensaje)")
         return
-    opciones = [f"Hoy {target_text} está re daun", f"Por ahora a {target_text} no se le activó el daun"]
-    await update.message.reply_text(random.choice(opciones))
+    await update.message.reply_text(random.choice(_ESDAUN_TEMPLATES).format(target_text))
 
 async def _only_private(update: Update) -> bool:
     return update.effective_chat and update.effective_chat.type == "private"
@@ -425,14 +645,11 @@ async def immune_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id, target_username = u.id, u.username
     elif m:
         target_username = m.group(1)
-    chat_id = None
-    for tok in text.split()[1:]:
-        if tok.isdigit() or (tok.startswith("-") and tok[1:].isdigit()):
-            chat_id = int(tok); break
+    chat_id = parse_chat_id_arg(text)
     if chat_id is None or not (target_user_id or target_username):
         await update.message.reply_text("Uso: /immune_add @usuario <chat_id>  • o •  en reply: /immune_add <chat_id>")
         return
-    ok = add_immune(chat_id, target_user_id, target_username)
+    ok = await _run_db(add_immune, chat_id, target_user_id, target_username)
     if ok:
         who = f"@{target_username}" if target_username else f"id={target_user_id}"
         await update.message.reply_text(f"Agregado como inmune en chat {chat_id}: {who}")
@@ -453,14 +670,11 @@ async def immune_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user_id, target_username = u.id, u.username
     elif m:
         target_username = m.group(1)
-    chat_id = None
-    for tok in text.split()[1:]:
-        if tok.isdigit() or (tok.startswith("-") and tok[1:].isdigit()):
-            chat_id = int(tok); break
+    chat_id = parse_chat_id_arg(text)
     if chat_id is None or not (target_user_id or target_username):
         await update.message.reply_text("Uso: /immune_remove @usuario <chat_id>  • o •  en reply: /immune_remove <chat_id>")
         return
-    removed = remove_immune(chat_id, target_user_id, target_username)
+    removed = await _run_db(remove_immune, chat_id, target_user_id, target_username)
     if removed:
         who = f"@{(target_username or '')}" if target_username else f"id={target_user_id}"
         await update.message.reply_text(f"Quitado de inmunes en chat {chat_id}: {who}")
@@ -481,7 +695,7 @@ async def immune_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("El chat_id debe ser numérico.")
         return
-    rows = list_immunes(chat_id)
+    rows = await _run_db(list_immunes, chat_id)
     if not rows:
         await update.message.reply_text("No hay inmunes en ese chat.")
         return
@@ -493,16 +707,37 @@ async def immune_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines.append(f"• {who}")
     await update.message.reply_text("Inmunes:\n" + "\n".join(lines))
 
-def do_daily_reset(context: ContextTypes.DEFAULT_TYPE):
+def purge_old_days(day):
+    cutoff = day - STATS_RETENTION_DAYS
+    with tx() as conn:
+        conn.execute(SQL_PURGE_SELECTION, (cutoff,))
+        if conn.execute(SQL_HAS_STATS_OLD).fetchone():
+            conn.execute(SQL_PURGE_STATS_OLD, (cutoff,))
+            if not conn.execute(SQL_ANY_STATS_OLD).fetchone():
+                conn.execute("DROP TABLE daily_stats_old")
     with db() as conn:
-        conn.execute("UPDATE users SET balance=?", (DAILY_START_BALANCE,))
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+async def do_daily_reset(context: ContextTypes.DEFAULT_TYPE):
+    # Los saldos se reinician solos en adjust_balance cuando balance_day queda atrás.
+    await _run_db(purge_old_days, today_key())
 
 def main():
     init_db()
     if not BOT_TOKEN:
         raise RuntimeError("Falta TELEGRAM_BOT_TOKEN en .env")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .pool_timeout(20)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .post_shutdown(flush_seen_on_shutdown)
+        .build()
+    )
     app.job_queue.run_daily(do_daily_reset, time=RESET_UTC_TIME, name="daily_reset")
+    app.job_queue.run_repeating(flush_seen, interval=5, name="flush_seen")
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("comandos", comandos))
     app.add_handler(CommandHandler("down", down))
@@ -515,7 +750,10 @@ def main():
     app.add_handler(CommandHandler("immune_remove", immune_remove))
     app.add_handler(CommandHandler("immune_list", immune_list))
     app.add_handler(ChatMemberHandler(seen_member, ChatMemberHandler.CHAT_MEMBER))
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.ALL, any_group_msg))
+    app.add_handler(
+        MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & ~filters.StatusUpdate.ALL & ~filters.COMMAND, any_group_msg),
+        group=1,
+    )
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":